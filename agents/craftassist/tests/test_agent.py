@@ -3,6 +3,7 @@ Copyright (c) Facebook, Inc. and its affiliates.
 """
 
 import unittest
+from unittest.mock import Mock, patch
 from droidlet.shared_data_structs import MockOpt
 from agents.craftassist.craftassist_agent import CraftAssistAgent
 
@@ -16,6 +17,27 @@ class BaseAgentTest(unittest.TestCase):
         opts = MockOpt()
         CraftAssistAgent(opts)
 
+    def test_memory_dump_to_early_dashboard_client(self):
+        # a client that connected while the agent was loading, before the agent
+        # registered its socketio event handlers
+        sio = Mock()
+        sio.manager.rooms = {"/": {None: {"early_sid": "early_eio_sid"}}}
+        with patch("agents.droidlet_agent.sio", sio):
+            agent = CraftAssistAgent(MockOpt())
+            agent.dashboard_memory_dump_time = 0
+            agent.maybe_dump_memory_to_dashboard()
+            agent.dashboard_memory_dump_future.result()
+        sio.emit.assert_any_call("memoryState", agent.dashboard_memory["db"])
+
+    def test_no_memory_dump_without_dashboard_client(self):
+        sio = Mock()
+        sio.manager.rooms = {}
+        with patch("agents.droidlet_agent.sio", sio):
+            agent = CraftAssistAgent(MockOpt())
+            agent.dashboard_memory_dump_time = 0
+            agent.maybe_dump_memory_to_dashboard()
+        assert agent.dashboard_memory_dump_future is None
+
 
 if __name__ == "__main__":
     unittest.main()
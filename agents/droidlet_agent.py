@@ -4,9 +4,10 @@ Copyright (c) Facebook, Inc. and its affiliates.
 import logging
 import random
 import time
-import numpy as np
 import datetime
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from agents.core import BaseAgent
 from agents.scheduler import EmptyScheduler
@@ -21,6 +22,15 @@ random.seed(0)
 DATABASE_FILE_FOR_DASHBOARD = "dashboard_data.db"
 DEFAULT_BEHAVIOUR_TIMEOUT = 20
 MEMORY_DUMP_KEYFRAME_TIME = 0.5
+# seconds before a cached speaker name -> player memid lookup is redone
+SPEAKER_MEMID_CACHE_TIMEOUT = 60
+# tables sent to the dashboard on each memory dump, keyed by their name in the payload
+DASHBOARD_MEMORY_QUERIES = {
+    "memories": "SELECT * FROM Memories",
+    "triples": "SELECT * FROM Triples",
+    "reference_objects": "SELECT * FROM ReferenceObjects",
+    "named_abstractions": "SELECT * FROM NamedAbstractions",
+}
 
 
 # a BaseAgent with:
@@ -28,6 +38,11 @@ MEMORY_DUMP_KEYFRAME_TIME = 0.5
 # 2: has a turnable head, can point, and has basic locomotion
 # 3: can send and receive chats
 class DroidletAgent(BaseAgent):
+    # this is "select TaskNodes that task_step might check or step": ones waiting on their
+    # init_condition (prio = -1), ones whose run/stop conditions are checked (prio >= 0),
+    # and ones that are running.  paused is checked per stage in python
+    _Q_TASKS = "SELECT MEMORY FROM Task WHERE ((prio>=-1) OR (running>=1))"
+
     def __init__(self, opts, name=None):
         logging.info("Agent.__init__ started")
         self.name = name or default_agent_name()
@@ -43,29 +58,42 @@ class DroidletAgent(BaseAgent):
         self.perceive_on_chat = False
         self.agent_type = None
         self.scheduler = EmptyScheduler()
+        # speaker name -> (player memid, time.time() it was looked up)
+        self.speaker_memid_cache = {}
+        # (chat, logical form memid) -> postprocessed logical form sent to the dashboard;
+        # cleared whenever a new chat is written to memory
+        self.lf_postprocess_cache = {}
+        # task_step runs this search every step, so it parses it once, on its first step.
+        # not done here: subclasses that override task_step (e.g. swarm workers) may
+        # have a memory without compile_search
+        self._q_tasks = None
 
         self.dashboard_memory_dump_time = time.time()
+        # db version the cached dashboard_memory["db"] was read at
+        self.dashboard_memory_db_version = None
+        # memory dumps are sent from a worker thread so step() doesn't block on socketio
+        self.dashboard_memory_dump_executor = ThreadPoolExecutor(max_workers=1)
+        self.dashboard_memory_dump_future = None
         self.dashboard_memory = {
             "db": {},
             "objects": [],
             "humans": [],
             "chatResponse": {},
-            "chats": [
-                {"msg": "", "failed": False},
-                {"msg": "", "failed": False},
-                {"msg": "", "failed": False},
-                {"msg": "", "failed": False},
-                {"msg": "", "failed": False},
-            ],
+            # ring buffer of the last 5 dashboard chats
+            "chats": deque([{"msg": "", "failed": False} for _ in range(5)], maxlen=5),
         }
         # Add optional logging for timeline
         if opts.log_timeline:
-            self.timeline_log_file = open("timeline_log.{}.txt".format(self.name), "a+")
+            # append only (O_APPEND) with an explicit encoding; events are block
+            # buffered and reach the file when the buffer fills or in __del__
+            self.timeline_log_file = open(
+                "timeline_log.{}.txt".format(self.name), "a", buffering=65536, encoding="utf-8"
+            )
 
-        # Add optional hooks for timeline
+        # Add optional hooks for timeline; only subscribe to the events that are
+        # shown in the timeline, memory events are too frequent to send
         if opts.enable_timeline:
             dispatch.connect(self.log_to_dashboard, "perceive")
-            dispatch.connect(self.log_to_dashboard, "memory")
             dispatch.connect(self.log_to_dashboard, "interpreter")
             dispatch.connect(self.log_to_dashboard, "dialogue")
 
@@ -129,25 +157,21 @@ class DroidletAgent(BaseAgent):
             """
             logging.debug("in send_text_command_to_agent, got the command: %r" % (command))
 
-            agent_chat = (
-                "<dashboard> " + command
-            )  # the chat is coming from a player called "dashboard"
-            self.dashboard_chat = agent_chat
-            status = "Sent successfully"
+            # the chat is coming from a player called "dashboard"
+            self.dashboard_chat = "<dashboard> " + command
             # update server memory
-            self.dashboard_memory["chats"].pop(0)
-            self.dashboard_memory["chats"].append({"msg": command, "failed": False})
-            payload = {
-                "status": status,
-                "chat": command,
-                "allChats": self.dashboard_memory["chats"],
-            }
-            sio.emit("setChatResponse", payload)
+            chats = self.dashboard_memory["chats"]
+            chats.append({"msg": command, "failed": False})
+            sio.emit(
+                "setChatResponse",
+                {"status": "Sent successfully", "chat": command, "allChats": list(chats)},
+            )
 
         @sio.on("getChatActionDict")
         def get_chat_action_dict(sid, chat):
             logging.debug(f"Looking for action dict for command [{chat}] in memory")
             logical_form = None
+            ref_obj_data = None
             try:
                 chat_memids, _ = self.memory.basic_search(
                     f"SELECT MEMORY FROM Chat WHERE chat={chat}"
@@ -159,9 +183,16 @@ class DroidletAgent(BaseAgent):
                     logical_form_mem = self.memory.get_mem_by_id(logical_form_triples[0][2])
                     logical_form = logical_form_mem.logical_form
                 if logical_form:
-                    logical_form = postprocess_logical_form(
-                        self.memory, speaker="dashboard", chat=chat, logical_form=logical_form_mem.logical_form
-                    )
+                    cache_key = (chat, logical_form_mem.memid)
+                    logical_form = self.lf_postprocess_cache.get(cache_key)
+                    if logical_form is None:
+                        logical_form = postprocess_logical_form(
+                            self.memory,
+                            speaker="dashboard",
+                            chat=chat,
+                            logical_form=logical_form_mem.logical_form,
+                        )
+                        self.lf_postprocess_cache[cache_key] = logical_form
                     where = "WHERE <<?, attended_while_interpreting, #{}>>".format(
                         logical_form_mem.memid
                     )
@@ -292,25 +323,36 @@ class DroidletAgent(BaseAgent):
         super().step()
         self.maybe_dump_memory_to_dashboard()
 
+    @staticmethod
+    def _update_task_status(mem, status):
+        """Write status to the task's node and copy what was written to mem.
+        get_update_status can override the requested values, e.g. a finished task
+        is set to prio -2 and running 0"""
+        status = mem.get_update_status(status)
+        mem.prio = status["prio"]
+        # running is None if it was not requested and the task never set it
+        if status["running"] is not None:
+            mem.running = status["running"]
+
     def task_step(self, sleep_time=0.25):
-        query = "SELECT MEMORY FROM Task WHERE prio=-1"
-        _, task_mems = self.memory.basic_search(query)
+        if self._q_tasks is None:
+            self._q_tasks = self.memory.compile_search(self._Q_TASKS)
+        # search once, and keep the nodes' prio/running in step with the status
+        # updates below, so that later stages see the tasks changed by earlier ones
+        _, task_mems = self.memory.basic_search(self._q_tasks)
         for mem in task_mems:
-            if mem.task.init_condition.check():
-                mem.get_update_status({"prio": 0})
+            if mem.prio == -1 and mem.task.init_condition.check():
+                self._update_task_status(mem, {"prio": 0})
 
-        # this is "select TaskNodes whose priority is >= 0 and are not paused"
-        query = "SELECT MEMORY FROM Task WHERE ((prio>=0) AND (paused <= 0))"
-        _, task_mems = self.memory.basic_search(query)
         for mem in task_mems:
+            if mem.prio < 0 or mem.paused > 0:
+                continue
             if mem.task.run_condition.check():
                 # eventually we need to use the multiplex filter to decide what runs
-                mem.get_update_status({"prio": 1, "running": 1})
+                self._update_task_status(mem, {"prio": 1, "running": 1})
             if mem.task.stop_condition.check():
-                mem.get_update_status({"prio": 0, "running": 0})
-        # this is "select TaskNodes that are runnning (running >= 1) and are not paused"
-        query = "SELECT MEMORY FROM Task WHERE ((running>=1) AND (paused <= 0))"
-        _, task_mems = self.memory.basic_search(query)
+                self._update_task_status(mem, {"prio": 0, "running": 0})
+        task_mems = [mem for mem in task_mems if mem.running >= 1 and mem.paused <= 0]
         if not task_mems:
             time.sleep(sleep_time)
             return
@@ -325,13 +367,25 @@ class DroidletAgent(BaseAgent):
         # n hundreth of seconds since agent init
         return self.memory.get_time()
 
+    def get_speaker_memid(self, speaker):
+        """Return the memid of the player named speaker.  The few speakers there are
+        rarely change memid, so the lookup is cached for SPEAKER_MEMID_CACHE_TIMEOUT
+        seconds instead of searching memory on every chat"""
+        now = time.time()
+        cached = self.speaker_memid_cache.get(speaker)
+        if cached is not None and now - cached[1] < SPEAKER_MEMID_CACHE_TIMEOUT:
+            return cached[0]
+        memid = self.memory.get_player_by_name(speaker).memid
+        self.speaker_memid_cache[speaker] = (memid, now)
+        return memid
+
     def process_language_perception(self, speaker, chat, preprocessed_chat, chat_parse):
         """this munges the results of the semantic parser and writes them to memory"""
 
+        # a new chat can change how coreferences in earlier ones resolve
+        self.lf_postprocess_cache.clear()
         # add postprocessed chat here
-        chat_memid = self.memory.add_chat(
-            self.memory.get_player_by_name(speaker).memid, preprocessed_chat
-        )
+        chat_memid = self.memory.add_chat(self.get_speaker_memid(speaker), preprocessed_chat)
         post_processed_parse = postprocess_logical_form(
             self.memory, speaker=speaker, chat=chat, logical_form=chat_parse
         )
@@ -344,7 +398,9 @@ class DroidletAgent(BaseAgent):
         return logical_form_memid, chat_memid
 
     def perceive(self, force=False):
-        start_time = datetime.datetime.now()
+        # perceive runs every step, but the timestamps are only needed when a chat
+        # comes in; take a cheap monotonic reading now and build datetimes later
+        start_perf = time.perf_counter()
 
         # run the semantic parsing model (and other chat munging):
         nlu_perceive_output = self.perception_modules["language_understanding"].perceive(
@@ -359,12 +415,13 @@ class DroidletAgent(BaseAgent):
             self.process_language_perception(speaker, chat, preprocessed_chat, chat_parse)
 
             # Send data to the dashboard timeline
+            elapsed_time = time.perf_counter() - start_perf
             end_time = datetime.datetime.now()
             hook_data = {
                 "name": "perceive",
-                "start_time": start_time,
+                "start_time": end_time - datetime.timedelta(seconds=elapsed_time),
                 "end_time": end_time,
-                "elapsed_time": (end_time - start_time).total_seconds(),
+                "elapsed_time": elapsed_time,
                 "agent_time": self.get_time(),
                 "speaker": speaker,
                 "chat": chat,
@@ -397,13 +454,24 @@ class DroidletAgent(BaseAgent):
             )
 
         # check to see if some Tasks were put in memory that need to be
-        # hatched using agent object (self):
-        query = "SELECT MEMORY FROM Task WHERE prio==-3"
-        _, task_mems = self.memory.basic_search(query)
-        for task_mem in task_mems:
-            task_mem.task["class"](
-                self, task_data=task_mem.task["task_data"], memid=task_mem.memid
-            )
+        # hatched using agent object (self); memory flags when any were stored,
+        # so skip the search on the (usual) steps where none were:
+        if self.memory._pending_hatch:
+            # clear the flag first, hatching a Task may store new unhatched ones
+            self.memory._pending_hatch = False
+            query = "SELECT MEMORY FROM Task WHERE prio==-3"
+            _, task_mems = self.memory.basic_search(query)
+            hatched = 0
+            try:
+                for task_mem in task_mems:
+                    task_mem.task["class"](
+                        self, task_data=task_mem.task["task_data"], memid=task_mem.memid
+                    )
+                    hatched += 1
+            finally:
+                # if a Task failed to hatch, look for the remaining ones next step
+                if hatched < len(task_mems):
+                    self.memory._pending_hatch = True
 
     def maybe_run_slow_defaults(self):
         """Pick a default task task to run
@@ -420,17 +488,16 @@ class DroidletAgent(BaseAgent):
         )
         defaults = [(p, f) for (p, f) in defaults if f not in self.memory.banned_default_behaviors]
 
-        def noop(*args):
-            pass
-
-        defaults.append((1 - sum(p for p, _ in defaults), noop))  # noop with remaining prob
+        # do nothing with the remaining probability; this is the common case,
+        # so check it before doing the weighted choice
+        if random.random() >= sum(p for p, _ in defaults):
+            return
         # weighted random choice of functions
         p, fns = zip(*defaults)
-        fn = np.random.choice(fns, p=p)
-        if fn != noop:
-            logging.debug("Default behavior: {}".format(fn))
+        fn = random.choices(fns, weights=p, k=1)[0]
+        logging.debug("Default behavior: {}".format(fn))
 
-        if type(fn) == tuple:
+        if isinstance(fn, tuple):
             # this function has arguments
             f, args = fn
             f(self, args)
@@ -439,41 +506,58 @@ class DroidletAgent(BaseAgent):
             fn(self)
 
     def maybe_dump_memory_to_dashboard(self):
+        if not dashboard_connected():
+            # nobody is listening, don't bother reading the tables
+            return
         if time.time() - self.dashboard_memory_dump_time > MEMORY_DUMP_KEYFRAME_TIME:
+            future = self.dashboard_memory_dump_future
+            if future is not None and not future.done():
+                # the previous dump is still being sent, don't pile up another one
+                return
             self.dashboard_memory_dump_time = time.time()
-            memories_main = self.memory._db_read("SELECT * FROM Memories")
-            triples = self.memory._db_read("SELECT * FROM Triples")
-            reference_objects = self.memory._db_read("SELECT * FROM ReferenceObjects")
-            named_abstractions = self.memory._db_read("SELECT * FROM NamedAbstractions")
-            self.dashboard_memory["db"] = {
-                "memories": memories_main,
-                "triples": triples,
-                "reference_objects": reference_objects,
-                "named_abstractions": named_abstractions,
-            }
-            sio.emit("memoryState", self.dashboard_memory["db"])
+            # only re-read the tables if something was written since the last dump
+            db_version = self.memory.get_db_version()
+            if db_version != self.dashboard_memory_db_version:
+                # read all the tables in one transaction
+                rows = self.memory._db_read_many(list(DASHBOARD_MEMORY_QUERIES.values()))
+                self.dashboard_memory["db"] = {
+                    name: rows[query] for name, query in DASHBOARD_MEMORY_QUERIES.items()
+                }
+                self.dashboard_memory_db_version = db_version
+            self.dashboard_memory_dump_future = self.dashboard_memory_dump_executor.submit(
+                sio.emit, "memoryState", self.dashboard_memory["db"]
+            )
 
     def log_to_dashboard(self, **kwargs):
         """Emits the event to the dashboard and/or logs it in a file"""
         if self.opts.enable_timeline:
-            result = kwargs["data"]
-            # a sample filter for logging data from perceive and dialogue
-            allowed = ["perceive", "dialogue", "interpreter"]
-            if result["name"] in allowed:
-                # JSONify the data, then send it to the dashboard and/or log it
-                result = json.dumps(result, default=str)
-                self.agent_emit(result)
-                if self.opts.log_timeline:
-                    self.timeline_log_file.flush()
-                    print(result, file=self.timeline_log_file)
+            # JSONify the data once, then send it to the dashboard and/or log it
+            result = json.dumps(kwargs["data"], default=str)
+            self.agent_emit(result)
+            if self.opts.log_timeline:
+                self.timeline_log_file.write(result + "\n")
 
     def agent_emit(self, result):
         sio.emit("newTimelineEvent", result)
 
     def __del__(self):
-        """Close the timeline log file"""
+        """Close the timeline log file and stop the memory dump thread"""
         if getattr(self, "timeline_log_file", None):
             self.timeline_log_file.close()
+        if getattr(self, "dashboard_memory_dump_executor", None):
+            self.dashboard_memory_dump_executor.shutdown(wait=False)
+
+
+def dashboard_connected():
+    """Whether any dashboard client is connected.  This is read from socketio's own
+    client manager, so clients that connected while the agent was still loading,
+    before its event handlers were registered, are counted too"""
+    manager = getattr(sio, "manager", None)
+    if manager is None:
+        # the dashboard isn't running, sio is the no-op mock
+        return False
+    # the None room of a namespace holds every client connected to it
+    return bool(manager.rooms.get("/", {}).get(None))
 
 
 def default_agent_name():
@@ -143,7 +143,9 @@ class LocobotAgent(DroidletAgent):
             for o in objects:
                 del o["feature_repr"]  # pickling optimization
             self.dashboard_memory["objects"] = objects
-            sio.emit("updateState", {"memory": self.dashboard_memory})
+            # chats is a deque, which socketio can't serialize
+            memory = dict(self.dashboard_memory, chats=list(self.dashboard_memory["chats"]))
+            sio.emit("updateState", {"memory": memory})
 
         @sio.on("interaction data")
         def log_interaction_data(sid, interactionData):
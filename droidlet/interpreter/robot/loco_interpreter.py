@@ -2,6 +2,7 @@
 Copyright (c) Facebook, Inc. and its affiliates.
 """
 
+import random
 from typing import Tuple, Dict, Any, Optional
 
 from droidlet.memory.memory_nodes import PlayerNode
@@ -83,9 +84,9 @@ class LocoInterpreter(Interpreter):
         if len(objs) == 0:
             raise ErrorWithResponse("I don't know what you want me to get.")
 
-        if all(isinstance(obj, PlayerNode) for obj in objs):
-            raise ErrorWithResponse("I can't get a person, sorry!")
         objs = [obj for obj in objs if not isinstance(obj, PlayerNode)]
+        if len(objs) == 0:
+            raise ErrorWithResponse("I can't get a person, sorry!")
 
         if d.get("receiver") is None:
             receiver_d = None
@@ -134,18 +135,18 @@ class LocoInterpreter(Interpreter):
                     return t
 
             dance_type = d.get("dance_type", {})
-            if dance_type.get("point"):
-                target = self.subinterpret["point_target"](self, speaker, dance_type["point"])
+            point = dance_type.get("point")
+            look_turn = dance_type.get("look_turn")
+            body_turn = dance_type.get("body_turn")
+            if point:
+                target = self.subinterpret["point_target"](self, speaker, point)
                 t = self.task_objects["point"](agent, {"target": target})
-            elif dance_type.get("look_turn") or dance_type.get("body_turn"):
-                lt = dance_type.get("look_turn")
-                if lt:
-                    f = self.subinterpret["facing"](self, speaker, lt, head_or_body="head")
-                    t = self.task_objects["look"](agent, f)
-                else:
-                    bt = dance_type.get("body_turn")
-                    f = self.subinterpret["facing"](self, speaker, bt, head_or_body="body")
-                    t = self.task_objects["turn"](agent, f)
+            elif look_turn:
+                f = self.subinterpret["facing"](self, speaker, look_turn, head_or_body="head")
+                t = self.task_objects["look"](agent, f)
+            elif body_turn:
+                f = self.subinterpret["facing"](self, speaker, body_turn, head_or_body="body")
+                t = self.task_objects["turn"](agent, f)
             else:
                 if location_d is None:
                     dance_location = None
@@ -155,13 +156,19 @@ class LocoInterpreter(Interpreter):
                     dance_location, _ = self.subinterpret["specify_locations"](
                         self, speaker, mems, steps, reldir
                     )
-                filters_d = dance_type.get("filters", {})
-                filters_d["memory_type"] = "DANCES"
-                F = self.subinterpret["filters"](self, speaker, dance_type.get("filters", {}))
-                dance_memids, _ = F()
-                # TODO correct selector in filters
-                if dance_memids:
-                    dance_memid = random.choice(dance_memids)
+                filters_d = dance_type.get("filters") or {}
+                # a where_clause, selector, coref etc. restrict the dance, so the
+                # filters interpreter has to handle it
+                if any(v for k, v in filters_d.items() if k != "memory_type"):
+                    filters_d["memory_type"] = "DANCES"
+                    F = self.subinterpret["filters"](self, speaker, filters_d)
+                    dance_memids, _ = F()
+                    # TODO correct selector in filters
+                    dance_memid = random.choice(dance_memids) if dance_memids else None
+                else:
+                    # any dance will do, let the db pick one instead of fetching them all
+                    dance_memid = self.memory.get_random_memid("Dance")
+                if dance_memid is not None:
                     dance_mem = self.memory.get_mem_by_id(dance_memid)
                     dance_obj = dance.Movement(
                         agent=agent, move_fn=dance_mem.dance_fn, dance_location=dance_location
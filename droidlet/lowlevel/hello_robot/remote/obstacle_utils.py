@@ -1,19 +1,17 @@
 import open3d as o3d
 import numpy as np
-import copy
 import warnings
 
 
 def get_relative_bbox(base_position, region_shape, relative_position):
-    bbox = o3d.geometry.OrientedBoundingBox(
-        center=[0.0, 0.0, 0.0], R=np.identity((3)), extent=region_shape
-    )
-    bbox.translate(relative_position, relative=False)
-    if base_position[2] != 0:
-        rotz = o3d.geometry.get_rotation_matrix_from_axis_angle([0, 0, base_position[2]])
-        bbox.rotate(rotz, center=[0.0, 0.0, 0.0])
-    bbox.translate([base_position[0], base_position[1], 0.0], relative=True)
-    return bbox
+    # the box at relative_position, rotated about the origin by the base yaw and then
+    # moved to the base x, y; computed directly so the box is built in one call
+    c, s = np.cos(base_position[2]), np.sin(base_position[2])
+    rotz = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+    center = rotz @ np.asarray(relative_position, dtype=np.float64)
+    center[0] += base_position[0]
+    center[1] += base_position[1]
+    return o3d.geometry.OrientedBoundingBox(center=center, R=rotz, extent=region_shape)
 
 
 def get_relative_points(pcd, base_position, region_shape, relative_position):
@@ -22,6 +20,19 @@ def get_relative_points(pcd, base_position, region_shape, relative_position):
     return cropped_pcd, bbox
 
 
+def get_relative_points_np(points, base_position, region_shape, relative_position):
+    # numpy version of get_relative_points for an (N, 3) array of points: moves the
+    # points into the base frame and keeps the ones inside the (now axis-aligned) box
+    c, s = np.cos(base_position[2]), np.sin(base_position[2])
+    dx = points[:, 0] - base_position[0]
+    dy = points[:, 1] - base_position[1]
+    half_extent = np.asarray(region_shape, dtype=np.float64) / 2
+    mask = np.abs(c * dx + s * dy - relative_position[0]) <= half_extent[0]
+    mask &= np.abs(c * dy - s * dx - relative_position[1]) <= half_extent[1]
+    mask &= np.abs(points[:, 2] - relative_position[2]) <= half_extent[2]
+    return points[mask]
+
+
 def get_points_in_front(
     pcd, base_position, min_dist=0.3, max_dist=1.0, robot_width=0.4, height=1.0
 ):
@@ -30,25 +41,114 @@ def get_points_in_front(
     )
 
 
+def get_points_in_front_np(
+    points, base_position, min_dist=0.3, max_dist=1.0, robot_width=0.4, height=1.0
+):
+    return get_relative_points_np(
+        points, base_position, [max_dist - min_dist, robot_width, height], [min_dist, 0.0, 0.0]
+    )
+
+
+# get_ground_plane only downsamples scans with more points than this before the plane
+# fit; RANSAC on smaller scans is cheap enough that downsampling isn't worth its cost
+DOWNSAMPLE_MIN_POINTS = 5000
+
+
+def spread_bits(v):
+    """spreads the low 21 bits of each uint64 in v out to every third bit"""
+    v = v & np.uint64(0x1FFFFF)
+    for shift, mask in (
+        (32, 0x1F00000000FFFF),
+        (16, 0x1F0000FF0000FF),
+        (8, 0x100F00F00F00F00F),
+        (4, 0x10C30C30C30C30C3),
+        (2, 0x1249249249249249),
+    ):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_downsample(points, r_filter):
+    """keeps one point of an (N, 3) array per r_filter-sized cell.  the cells are
+    ordered along a Z-order (Morton) curve, so that finding one point per cell is a
+    sort of their codes.  returns the indices of the kept points, in Z-order"""
+    q = np.floor((points - points.min(axis=0)) / r_filter).astype(np.uint64)
+    codes = spread_bits(q[:, 0]) | (spread_bits(q[:, 1]) << np.uint64(1))
+    codes |= spread_bits(q[:, 2]) << np.uint64(2)
+    _, keep = np.unique(codes, return_index=True)
+    return keep
+
+
+# open3d's tensor point cloud (0.16 and up) has a segment_plane that runs the
+# RANSAC iterations in parallel, the legacy one runs them on a single thread
+USE_TENSOR_SEGMENT_PLANE = hasattr(o3d, "t") and hasattr(
+    o3d.t.geometry.PointCloud, "segment_plane"
+)
+
+
+def segment_plane(scan, distance_threshold, ransac_n, num_iterations):
+    """fits a plane to the legacy point cloud scan with RANSAC.
+    returns the plane model [a, b, c, d] and the indices of its inliers as numpy arrays"""
+    if USE_TENSOR_SEGMENT_PLANE:
+        tscan = o3d.t.geometry.PointCloud.from_legacy(scan)
+        plane_model, inliers = tscan.segment_plane(
+            distance_threshold=distance_threshold, ransac_n=ransac_n, num_iterations=num_iterations
+        )
+        return plane_model.numpy(), inliers.numpy()
+    plane_model, inliers = scan.segment_plane(
+        distance_threshold=distance_threshold, ransac_n=ransac_n, num_iterations=num_iterations
+    )
+    return np.asarray(plane_model), np.array(inliers)
+
+
+def get_ground_indexes(
+    scan, points=None, distance_threshold=0.06, ransac_n=3, num_iterations=100, voxel_size=None
+):
+    """returns the indices of the points of scan on its ground plane.  points is
+    np.asarray(scan.points), for callers that already have it"""
+    if points is None:
+        points = np.asarray(scan.points)
+    if points.shape[0] < ransac_n:
+        return np.zeros(0, dtype=np.int64)
+    fit_scan = scan
+    if voxel_size and points.shape[0] > DOWNSAMPLE_MIN_POINTS:
+        # fit on one measured point per voxel_size cell (rather than on voxel centroids)
+        keep = morton_downsample(points, voxel_size)
+        if keep.shape[0] >= ransac_n:
+            fit_scan = scan.select_by_index(keep)
+    ground_model, ground_indexes = segment_plane(
+        fit_scan, distance_threshold, ransac_n, num_iterations
+    )
+    if fit_scan is not scan:
+        # RANSAC's cost is linear in the number of points, so the plane was fit
+        # on the downsampled scan; split the full scan by distance to that plane
+        dists = np.abs(points @ ground_model[:3] + ground_model[3])
+        ground_indexes = np.flatnonzero(dists < distance_threshold)
+    return ground_indexes
+
+
 def get_ground_plane(
-    scan, distance_threshold=0.06, ransac_n=3, num_iterations=100, return_ground=True
+    scan,
+    distance_threshold=0.06,
+    ransac_n=3,
+    num_iterations=100,
+    return_ground=True,
+    voxel_size=None,
 ):
-    num_points = np.asarray(scan.points).shape[0]
-    if num_points < ransac_n:
+    points = np.asarray(scan.points)
+    if points.shape[0] < ransac_n:
         if return_ground:
             return o3d.geometry.PointCloud(), scan
         else:
             return scan
-    pcd = copy.deepcopy(scan)
 
-    ground_model, ground_indexes = scan.segment_plane(
-        distance_threshold=distance_threshold, ransac_n=ransac_n, num_iterations=num_iterations
+    ground_indexes = get_ground_indexes(
+        scan, points, distance_threshold, ransac_n, num_iterations, voxel_size
     )
-    ground_indexes = np.array(ground_indexes)
-
-    rest = pcd.select_by_index(ground_indexes, invert=True)
+    # segment_plane doesn't modify scan, and select_by_index returns new clouds
+    rest = scan.select_by_index(ground_indexes, invert=True)
     if return_ground:
-        ground = pcd.select_by_index(ground_indexes)
+        ground = scan.select_by_index(ground_indexes)
         return ground, rest
     else:
         return rest
@@ -64,22 +164,42 @@ def is_obstacle(
     height=1.0,
     fastmath=False,
     return_viz=False,
+    voxel_size=0.02,
+    ground_height=0.06,
 ):
     # print("num points", np.asarray(pcd.points).shape)
-    crop, bbox = get_points_in_front(pcd, base_pos, min_dist, max_dist, robot_width, height)
-    # print("num cropped", np.asarray(crop.points).shape)
-    num_cropped_points = np.asarray(crop.points).shape[0]
+    if fastmath and not return_viz:
+        # only the cropped points' heights are needed, crop with numpy
+        # instead of building a cropped point cloud
+        crop = bbox = None
+        crop_points = get_points_in_front_np(
+            np.asarray(pcd.points), base_pos, min_dist, max_dist, robot_width, height
+        )
+    else:
+        crop, bbox = get_points_in_front(pcd, base_pos, min_dist, max_dist, robot_width, height)
+        crop_points = np.asarray(crop.points)
+    # print("num cropped", crop_points.shape)
+    num_cropped_points = crop_points.shape[0]
     obstacle = False
+    rest = None
     if num_cropped_points < pix_threshold:
         warnings.warn(
             "[is_obstacle] for obstacle check, not able to see directly in front of robot, tilt the camera further down"
         )
-    if fastmath:
-        # TODO: make this based on not detecting ground plane, but directly cropping bounding box in front, at a certain height
-        raise RuntimeError("Not Implemented")
-    elif num_cropped_points >= pix_threshold:
-        rest = get_ground_plane(crop, return_ground=False)
-        obstacle = np.asarray(rest.points).shape[0] > 100
+    elif fastmath:
+        # no ground plane fit: the box in front is only rotated about z, so the points
+        # in it more than ground_height above the floor (z = 0) are the obstacle points
+        above_ground = crop_points[:, 2] > ground_height
+        obstacle = int(np.count_nonzero(above_ground)) > 100
+        if return_viz:
+            rest = crop.select_by_index(np.flatnonzero(above_ground))
+    elif return_viz:
+        rest = get_ground_plane(crop, return_ground=False, voxel_size=voxel_size)
+        obstacle = len(rest.points) > 100
+    else:
+        # only the number of points off the ground plane is needed, not the points
+        ground_indexes = get_ground_indexes(crop, crop_points, voxel_size=voxel_size)
+        obstacle = num_cropped_points - len(ground_indexes) > 100
     if return_viz:
         return obstacle, pcd, crop, bbox, rest
     else:
@@ -87,8 +207,10 @@ def is_obstacle(
 
 
 def get_o3d_pointcloud(points, colors):
-    points, colors = points.reshape(-1, 3), colors.reshape(-1, 3)
-    colors = colors / 255.0
+    # Vector3dVector copies from contiguous float64 arrays as is; build exactly those,
+    # scaling the colors straight into a float64 buffer
+    points = np.ascontiguousarray(points.reshape(-1, 3), dtype=np.float64)
+    colors = np.multiply(colors.reshape(-1, 3), 1.0 / 255.0, dtype=np.float64)
     opcd = o3d.geometry.PointCloud()
     opcd.points = o3d.utility.Vector3dVector(points)
     opcd.colors = o3d.utility.Vector3dVector(colors)
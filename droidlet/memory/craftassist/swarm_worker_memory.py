@@ -44,6 +44,7 @@ class SwarmWorkerMemory:
         self.receive_queue = memory_receive_queue
         self.memory_tag = memory_tag
         self.receive_dict = {}
+        self._pending_hatch = False
         self.init_time_interface(agent_time)
         self._safe_pickle_saved_attrs = {}
         mem_id_len = len(uuid.uuid4().hex)
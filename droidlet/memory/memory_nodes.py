@@ -937,6 +937,9 @@ class TaskNode(MemoryNode):
             run_count,
             memory.get_time(),
         )
+        if prio == -3:
+            # let the agent know there is an egg to hatch
+            memory._pending_hatch = True
         return memid
 
     def step(self, agent):
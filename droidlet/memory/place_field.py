@@ -2,17 +2,41 @@
 Copyright (c) Facebook, Inc. and its affiliates.
 """
 
+import math
 import numpy as np
+from itertools import repeat
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 MAX_MAP_SIZE = 4097
 MAP_INIT_SIZE = 1025
-BIG_I = MAX_MAP_SIZE
-BIG_J = MAX_MAP_SIZE
+# dtype and initial value of each of the maps kept for a slice
+MAP_DTYPES = {"updated": (np.int64, -1), "map": (np.uint8, 0), "memids": (np.int32, 0)}
+# update_map batches changes through update_map_bulk when there are more than this many
+BULK_UPDATE_MIN_CHANGES = 8
+
+
+def write_changes(map_, memids, updated, i, j, memid_idx, obstacle, t):
+    """writes the changes at locations (i[k], j[k]) into a slice's maps in order,
+    so that if several changes are at the same location the last one wins"""
+    for k in range(i.shape[0]):
+        map_[i[k], j[k]] = obstacle[k]
+        memids[i[k], j[k]] = memid_idx[k]
+        updated[i[k], j[k]] = t
+
+
+# when numba is available write_changes is compiled; otherwise update_map_bulk
+# writes with numpy fancy indexing instead of calling it
+if njit is not None:
+    write_changes = njit(cache=True)(write_changes)
 
 
-def no_y_l1(self, xyz, k):
+def no_y_l1(xyz, k):
     """returns the l1 distance between two standard coordinates"""
-    return np.linalg.norm(np.asarray([xyz[0], xyz[2]]) - np.asarray([k[0], k[2]]), ord=1)
+    return abs(xyz[0] - k[0]) + abs(xyz[2] - k[2])
 
 
 # TODO tighter integration with reference objects table, main memory update
@@ -29,6 +53,10 @@ class PlaceField:
 
     the .place_fields attribute is a dict with keys corresponding to heights,
     and values {"map": 2d numpy array, "updated": 2d numpy array, "memids": 2d numpy array}
+    of dtypes uint8, int64 and int32 respectively (see MAP_DTYPES), and "half": the
+    index of the map's center row/column, which is where x = 0 (resp. z = 0) goes.
+    all slices have the same width, and their arrays are views into 3d arrays, one per
+    field: .maps3d["map"][k] is the map of the slice at height .slice_heights[k]
     place_fields[h]["map"] is an occupany map at the the height h (in agent coordinates)
                            a location is 0 if there is nothing there or it is unseen, 1 if occupied
     place_fields[h]["memids"] gives a memid index for the ReferenceObject at that location,
@@ -58,7 +86,21 @@ class PlaceField:
         self.examined = {}
         self.examined_id = set()
         self.last = None
+        # the keys of self.examined in insertion order, and their x, z coordinates
+        # in the first len(self.examined_keys) rows of self.examined_xz, for get_closest
+        self.examined_keys = []
+        self.examined_xz = np.empty((16, 2))
+
+        # gives an index allowing quick lookup by memid
+        # each entry is keyed by a memid and is a dict
+        # {(i, j, h) : True}
+        # for each placed h, i ,j
+        self.memid2locs = {}
 
+        # the maps of all the slices are stored together, in
+        # self.maps3d[field][self.slice_heights.index(h)]
+        self.maps3d = {}
+        self.slice_heights = []
         self.maps = {}
         self.maybe_add_memid("NULL")
         self.maybe_add_memid(memory.self_memid)
@@ -68,25 +110,15 @@ class PlaceField:
 
         self.pixels_per_unit = pixels_per_unit
 
-        # gives an index allowing quick lookup by memid
-        # each entry is keyed by a memid and is a dict
-        # {str(h*BIG_I*BIG_J + i*BIG_J + j) : True}
-        # for each placed h, i ,j
-        self.memid2locs = {}
-
+    # memid2locs is keyed by (i, j, h) tuples directly, so these are trivial
     def ijh2idx(self, i, j, h):
-        return str(h * BIG_I * BIG_J + i * BIG_J + j)
+        return i, j, h
 
     def idx2ijh(self, idx):
-        idx = int(idx)
-        j = idx % BIG_J
-        idx = (idx - j) // BIG_J
-        i = idx % BIG_I
-        h = (idx - i) // BIG_I
-        return i, j, h
+        return idx
 
     def pop_memid_loc(self, memid, i, j, h):
-        idx = self.hij2idx(h, i, j)
+        idx = self.ijh2idx(i, j, h)
         del self.memid2locs[memid][idx]
 
     def maybe_delete_loc(self, i, j, h, t, memid="NULL"):
@@ -112,11 +144,10 @@ class PlaceField:
         if is_move is set, asserts that there is precisely one loc
         corresponding to the memid
         """
-        assert memid
-        assert memid != "NULL"
+        if not memid or memid == "NULL":
+            raise ValueError("tried to delete locs from the place_field by memid without a memid")
         count = 0
-        for idx in self.memid2locs.get(memid, []):
-            i, j, h = self.idx2ijh(idx)
+        for i, j, h in self.memid2locs.get(memid, ()):
             self.maps[h]["memids"][i, j] = 0
             self.maps[h]["map"][i, j] = 0
             self.maps[h]["updated"][i, j] = t
@@ -150,38 +181,47 @@ class PlaceField:
             if a memid is set, the remove will occur only if the memid matches.
 
         the "is_obstacle" status can be changed without changing memid etc.
+
+        long lists of changes that only place things (no "is_delete" or "is_move")
+        are written by update_map_bulk
         """
         t = self.get_time()
+        if len(changes) > BULK_UPDATE_MIN_CHANGES and all(
+            c.get("pos") is not None and not c.get("is_delete") and not c.get("is_move")
+            for c in changes
+        ):
+            changes = self.update_map_bulk(changes, t)
         for c in changes:
             is_delete = c.get("is_delete", False)
             is_move = c.get("is_move", False)
             memid = c.get("memid", "NULL")
             p = c.get("pos")
             if p is None:
-                assert is_delete
                 # if the change is a remove, and is specified by memid:
-                if not memid:
-                    raise Exception("tried to update a map location without a location or a memid")
+                if not is_delete or not memid or memid == "NULL":
+                    raise ValueError(
+                        "tried to update a map location without a location or a memid"
+                    )
                 # warn if empty TODO?
                 self.delete_loc_by_memid(memid, t)
             else:
                 x, y, z = p
                 h = self.y2slice(y)
                 i, j = self.real2map(x, z, h)
-                s = max(i - self.map_size + 1, j - self.map_size + 1, -i, -j)
+                w = self.map_size
+                s = max(i - w + 1, j - w + 1, -i, -j)
                 if s > 0:
-                    self.extend_map(s)
-                i, j = self.real2map(x, z, h)
-                s = max(i - self.map_size + 1, j - self.map_size + 1, -i, -j)
-                if s > 0:
-                    # the map can not been extended enough to handle these bc MAX_MAP_SIZE
-                    # FIXME appropriate warning or error?
-                    continue
+                    if self.grow_map(h, s) < 0:
+                        # the map can not been extended enough to handle these bc MAX_MAP_SIZE
+                        # FIXME appropriate warning or error?
+                        continue
+                    i, j = self.real2map(x, z, h)
                 if is_delete:
                     self.maybe_delete_loc(i, j, h, t, memid=memid)
                 else:
                     if is_move:
-                        assert memid != "NULL"
+                        if memid == "NULL":
+                            raise ValueError("tried to move a map location without a memid")
                         self.delete_loc_by_memid(memid, t, is_move=True)
                     self.maps[h]["memids"][i, j] = self.memid2index.get(
                         memid, self.maybe_add_memid(memid)
@@ -190,7 +230,83 @@ class PlaceField:
                     self.maps[h]["updated"][i, j] = t
                     if not self.memid2locs.get(memid):
                         self.memid2locs[memid] = {}
-                    self.memid2locs[memid][self.ijh2idx(i, j, h)] = True
+                    self.memid2locs[memid][(i, j, h)] = True
+
+    def update_map_bulk(self, changes, t=None):
+        """
+        vectorized version of update_map for changes that place things on the map,
+        i.e. every change has a "pos" and neither "is_delete" nor "is_move" is set.
+        the changes are applied as if one at a time: if several land on the same
+        location, the last one is what ends up on the map.
+
+        the map is grown (once per slice) to fit the changes if it can be; if it can't,
+        the changes that fall outside it are returned, for update_map to deal with.
+        """
+        if t is None:
+            t = self.get_time()
+        by_slice = {}
+        for n, c in enumerate(changes):
+            by_slice.setdefault(self.y2slice(c["pos"][1]), []).append(n)
+        outside = []
+        for h, ns in by_slice.items():
+            pos = np.asarray([changes[n]["pos"] for n in ns], dtype=np.float64)
+            w = self.map_size
+            # rounds the same way as real2map
+            half = self.maps[h]["half"] + 0.5
+            i = np.floor(pos[:, 0] * self.pixels_per_unit + half).astype(np.int64)
+            j = np.floor(pos[:, 2] * self.pixels_per_unit + half).astype(np.int64)
+            s = int(max((i - w + 1).max(), (j - w + 1).max(), -i.min(), -j.min()))
+            if s > 0 and self.grow_map(h, s) > 0:
+                i += (self.map_size - w) // 2
+                j += (self.map_size - w) // 2
+                w = self.map_size
+            inside = (i >= 0) & (j >= 0) & (i < w) & (j < w)
+            if not inside.all():
+                outside.extend(changes[n] for n, ok in zip(ns, inside) if not ok)
+                ns = [n for n, ok in zip(ns, inside) if ok]
+                i = i[inside]
+                j = j[inside]
+            if not ns:
+                continue
+            memids = [changes[n].get("memid", "NULL") for n in ns]
+            memid_idx = np.array([self.maybe_add_memid(m) for m in memids], dtype=np.int32)
+            obstacle = np.array([changes[n].get("is_obstacle", 1) for n in ns], dtype=np.uint8)
+
+            flat = i * w + j
+            if njit is not None:
+                write_changes(
+                    self.maps[h]["map"],
+                    self.maps[h]["memids"],
+                    self.maps[h]["updated"],
+                    i,
+                    j,
+                    memid_idx,
+                    obstacle,
+                    t,
+                )
+            else:
+                # fancy-indexed writes don't say which of several writes to the same
+                # location wins, so keep only the last change at each location
+                _, last = np.unique(flat[::-1], return_index=True)
+                last = len(flat) - 1 - last
+                li = i[last]
+                lj = j[last]
+                self.maps[h]["memids"][li, lj] = memid_idx[last]
+                self.maps[h]["map"][li, lj] = obstacle[last]
+                self.maps[h]["updated"][li, lj] = t
+
+            # every change is recorded in memid2locs, even if overwritten later in the list,
+            # but each (memid, location) pair only needs to be entered once
+            pairs = np.unique(np.stack([memid_idx.astype(np.int64), flat]), axis=1)
+            starts = np.flatnonzero(np.diff(pairs[0], prepend=-1))
+            for m_idx, m_flat in zip(pairs[0, starts].tolist(), np.split(pairs[1], starts[1:])):
+                mi, mj = np.divmod(m_flat, w)
+                m = self.index2memid[m_idx]
+                locs = self.memid2locs.get(m)
+                if not locs:
+                    locs = self.memid2locs[m] = {}
+                locs.update(dict.fromkeys(zip(mi.tolist(), mj.tolist(), repeat(h)), True))
+        return outside
 
     # FIXME, want slices, esp for mc
     def y2slice(self, y):
@@ -200,23 +316,20 @@ class PlaceField:
         """
         convert an x, z coordinate in agent space to a pixel on the map
         """
-        n = self.maps[h]["map"].shape[0]
-        i = x * self.pixels_per_unit
-        j = z * self.pixels_per_unit
-        i = i + n // 2
-        j = j + n // 2
-        return round(i), round(j)
+        # round half up (not round()'s half to even), so that all the points of a
+        # pixel's width land on the same pixel
+        half = self.maps[h]["half"] + 0.5
+        return (
+            math.floor(x * self.pixels_per_unit + half),
+            math.floor(z * self.pixels_per_unit + half),
+        )
 
     def map2real(self, i, j, h):
         """
         convert an i, j pixel coordinate in the map to agent space
         """
-        n = self.maps[h]["map"].shape[0]
-        i = i - n // 2
-        j = j - n // 2
-        x = i / self.pixels_per_unit
-        z = j / self.pixels_per_unit
-        return x, z
+        half = self.maps[h]["half"]
+        return (i - half) / self.pixels_per_unit, (j - half) / self.pixels_per_unit
 
     def maybe_add_memid(self, memid):
         """
@@ -230,36 +343,87 @@ class PlaceField:
             self.memid2index[memid] = idx
         return idx
 
+    def grow_map(self, h, extension):
+        """
+        extends the maps (all slices share a width) by at least extension pixels on each side.
+        the maps are grown to (up to) twice their width, so that a map reached one pixel
+        at a time is copied O(log(width)) times rather than once per pixel.
+        returns the new width, or -1 if extension doesn't fit in MAX_MAP_SIZE
+        """
+        w = self.map_size
+        room = (MAX_MAP_SIZE - w) // 2
+        if extension > room:
+            return -1
+        return self.extend_map(h=h, extension=min(max(extension, w // 2), room))
+
+    def add_slice(self, h):
+        """adds a slice at height h to the maps"""
+        n = len(self.slice_heights)
+        w = self.map_size if n > 0 else MAP_INIT_SIZE
+        for m, (dtype, v) in MAP_DTYPES.items():
+            new_map = np.empty((n + 1, w, w), dtype=dtype)
+            if n > 0:
+                new_map[:n] = self.maps3d[m]
+            new_map[n] = v
+            self.maps3d[m] = new_map
+        self.slice_heights.append(h)
+        self.map_size = w
+        self.set_slice_views()
+
+    def set_slice_views(self):
+        """points self.maps[h] at the slices of the arrays in self.maps3d"""
+        half = self.map_size // 2
+        for k, h in enumerate(self.slice_heights):
+            self.maps[h] = {m: self.maps3d[m][k] for m in MAP_DTYPES}
+            self.maps[h]["half"] = half
+
     def extend_map(self, h=None, extension=1):
         assert extension >= 0
         if not h and len(self.maps) == 1:
             h = list(self.maps.keys())[0]
-        if not self.maps.get(h):
-            self.maps[h] = {}
-            for m, v in {"updated": -1, "map": 0, "memids": 0}.items():
-                self.maps[h][m] = v * np.ones((MAP_INIT_SIZE, MAP_INIT_SIZE))
-        w = self.maps[h]["map"].shape[0]
+        if h not in self.maps:
+            self.add_slice(h)
+        w = self.map_size
         new_w = w + 2 * extension
         if new_w > MAX_MAP_SIZE:
             return -1
-        for m, v in {"updated": -1, "map": 0, "memids": 0}.items():
-            new_map = v * np.ones((new_w, new_w))
-            new_map[extension:-extension, extension:-extension] = self.maps[h][m]
-            self.maps[h][m] = new_map
+        if extension == 0:
+            return w
+        e = extension
+        for m, (dtype, v) in MAP_DTYPES.items():
+            # every slice is extended, with one copy of the old maps and only
+            # the new border filled with the fill value
+            old_map = self.maps3d[m]
+            new_map = np.empty((old_map.shape[0], new_w, new_w), dtype=dtype)
+            new_map[:, e:-e, e:-e] = old_map
+            new_map[:, :e, :] = v
+            new_map[:, -e:, :] = v
+            new_map[:, e:-e, :e] = v
+            new_map[:, e:-e, -e:] = v
+            self.maps3d[m] = new_map
+        self.map_size = new_w
+        self.set_slice_views()
+        # the locations already on the map moved by extension in i and j
+        for memid, locs in self.memid2locs.items():
+            self.memid2locs[memid] = {(i + e, j + e, h): v for (i, j, h), v in locs.items()}
         return new_w
 
     def get_closest(self, xyz):
         """returns closest examined point to xyz"""
-        c = None
-        dist = 1.5
-        for k, v in self.examined.items():
-            if no_y_l1(k, xyz) < dist:
-                dist = no_y_l1(k, xyz)
-                c = k
-        if c is None:
-            self.examined[xyz] = 0
-            return xyz
-        return c
+        n = len(self.examined_keys)
+        if n > 0:
+            dists = np.abs(self.examined_xz[:n] - (xyz[0], xyz[2])).sum(axis=1)
+            k = dists.argmin()
+            if dists[k] < 1.5:
+                return self.examined_keys[k]
+        self.examined[xyz] = 0
+        if n == self.examined_xz.shape[0]:
+            grown = np.empty((2 * n, 2))
+            grown[:n] = self.examined_xz
+            self.examined_xz = grown
+        self.examined_xz[n] = xyz[0], xyz[2]
+        self.examined_keys.append(xyz)
+        return xyz
 
     def update(self, target):
         """called each time a region is examined. Updates relevant states."""
@@ -271,15 +435,15 @@ class PlaceField:
         self.examined = {}
         self.examined_id = set()
         self.last = None
+        self.examined_keys = []
 
     def can_examine(self, x):
         """decides whether to examine x or not."""
         loc = x["xyz"]
         k = self.get_closest(x["xyz"])
-        val = True
-        if self.last is not None and self.l1(cls.last, k) < 1:
-            val = False
         val = self.examined[k] < 2
+        if self.last is not None and no_y_l1(self.last, k) < 1:
+            val = False
         print(
             f"can_examine {x['eid'], x['label'], x['xyz'][:2]}, closest {k[:2]}, can_examine {val}"
         )
@@ -3,7 +3,7 @@ Copyright (c) Facebook, Inc. and its affiliates.
 """
 import unittest
 from droidlet.memory.robot.loco_memory import LocoAgentMemory
-from droidlet.memory.robot.loco_memory_nodes import DetectedObjectNode
+from droidlet.memory.robot.loco_memory_nodes import DetectedObjectNode, DanceNode
 from droidlet.base_util import Pos, Look, Player
 
 
@@ -70,6 +70,23 @@ class BasicTest(unittest.TestCase):
         assert len(self.memory.get_triples(obj_text="generate_num_10")) == 1
         assert len(self.memory.get_triples(obj_text="dance_with_numbers")) == 1
 
+    def test_get_random_memid(self):
+        self.memory = LocoAgentMemory()
+        assert self.memory.get_random_memid("Dance") is None
+
+        def return_num():
+            return 10
+
+        dance_memid = self.memory.add_dance(return_num, "generate_num_10_dance")
+        # snapshots are not picked
+        DanceNode(self.memory, dance_memid).snapshot(self.memory)
+        for _ in range(10):
+            assert self.memory.get_random_memid("Dance") == dance_memid
+
+        dance_memids = {dance_memid, self.memory.add_dance(return_num, "another_dance")}
+        picked = {self.memory.get_random_memid("Dance") for _ in range(100)}
+        assert picked == dance_memids
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -76,6 +76,8 @@ class AgentMemory:
         self_memid (str): MemoryID for the AgentMemory
         searcher (MemorySearcher): A class to process searches through memory
         time (int): The time of the agent
+        _pending_hatch (bool): set when an unhatched (prio -3) Task is stored,
+                               cleared by the agent when it hatches them
     """
 
     def __init__(
@@ -95,6 +97,7 @@ class AgentMemory:
             os.remove(db_file)
         self.db = sqlite3.connect(db_file, check_same_thread=False)
         self.task_db = {}
+        self._pending_hatch = False
         self._safe_pickle_saved_attrs = {}
 
         self.on_delete_callback = on_delete_callback
@@ -274,6 +277,27 @@ class AgentMemory:
         (r,) = self._db_read_one("SELECT node_type FROM Memories WHERE uuid=?", memid)
         return r
 
+    def get_random_memid(self, memtype: str) -> Optional[str]:
+        """Return the memid of a random (non-snapshot) memory whose node type is
+        memtype or one of its children, or None if there are none.  The sampling
+        is done by sqlite, so only the chosen row is read back.
+
+        Args:
+            memtype (string): the node type, e.g. "Dance"
+
+        Examples::
+            >>> get_random_memid("Dance")
+        """
+        node_types = self.node_children.get(memtype, [])
+        if not node_types:
+            return None
+        r = self._db_read_one(
+            "SELECT uuid FROM Memories WHERE node_type IN ({}) AND is_snapshot=0 "
+            "ORDER BY RANDOM() LIMIT 1".format(",".join("?" * len(node_types))),
+            *node_types,
+        )
+        return r[0] if r else None
+
     def get_mem_by_id(self, memid: str, node_type: str = None) -> "MemoryNode":
         """Given the memid and an optional node_type,
         return the memory node
@@ -363,6 +387,22 @@ class AgentMemory:
         """
         return self.searcher.search(self, query=query)
 
+    def compile_search(self, query):
+        """Convert a sqly query string into the FILTERS dict form, so that
+        a query that is run repeatedly only needs to be parsed once.
+
+        Args:
+            query (string): A sqly query
+
+        Returns:
+            dict: a FILTERS dict that can be passed to basic_search
+
+        Examples::
+            >>> q = compile_search("SELECT MEMORY FROM Task WHERE prio=-1")
+            >>> basic_search(q)
+        """
+        return self.searcher.maybe_convert_query(query)
+
     #################
     ###  Triples  ###
     #################
@@ -994,6 +1034,41 @@ class AgentMemory:
             logging.error("Bad read: {} : {}".format(query, args))
             raise
 
+    def _db_read_many(self, queries: Sequence[str]) -> dict:
+        """Run several argument-free queries against the database inside a
+        single read transaction, so they see one consistent snapshot and
+        pay for one BEGIN/COMMIT instead of one per query.
+
+        Args:
+            queries (list[string]): The SQL queries to be run against the database
+
+        Returns:
+            dict: maps each query to the list of tuples it returned
+
+        Examples::
+            >>> _db_read_many(["SELECT * FROM Memories", "SELECT * FROM Triples"])
+        """
+        c = self.db.cursor()
+        # don't nest: if a transaction is already open, just read inside it
+        began = not self.db.in_transaction
+        try:
+            if began:
+                c.execute("BEGIN")
+            out = {}
+            for query in queries:
+                c.execute(query)
+                out[query] = c.fetchall()
+            if began:
+                c.execute("COMMIT")
+            return out
+        except:
+            logging.error("Bad read: {}".format(queries))
+            if began and self.db.in_transaction:
+                self.db.rollback()
+            raise
+        finally:
+            c.close()
+
     def db_write(self, query: str, *args) -> int:
         """Return the number of rows affected.  As a side effect,
            sets the updated_time entry for each affected memory,
@@ -1079,6 +1154,13 @@ class AgentMemory:
         except AttributeError:
             return None
 
+    def get_db_version(self):
+        """Return a counter that increases whenever a row in the database is
+        inserted, updated or deleted (including by triggers), whether or not
+        db logging is enabled.  Can be used to tell whether cached reads of
+        the database are stale."""
+        return self.db.total_changes
+
     def _write_to_db_log(self, s: str, *args, no_format=False):
         """Write to database log file
 
@@ -316,6 +316,73 @@ class BasicTest(unittest.TestCase):
         triples = self.memory.get_triples(subj=jane_memid, pred_text="sister_of")
         assert len(triples) == 0
 
+    def test_db_read_many(self):
+        self.memory = AgentMemory()
+        joe_memid = PlayerNode.create(self.memory, Player(10, "joe", Pos(1, 0, 1), Look(0, 0)))
+        queries = [
+            "SELECT uuid FROM Memories WHERE node_type='Player'",
+            "SELECT uuid, x, y, z FROM ReferenceObjects",
+        ]
+        out = self.memory._db_read_many(queries)
+        assert set(out.keys()) == set(queries)
+        assert out[queries[0]] == [(joe_memid,)]
+        assert out[queries[1]] == self.memory._db_read(queries[1])
+        assert not self.memory.db.in_transaction
+
+        # inside an open transaction the reads join it, and leave it open
+        self.memory.db.execute("BEGIN")
+        out = self.memory._db_read_many(queries)
+        assert out[queries[0]] == [(joe_memid,)]
+        assert self.memory.db.in_transaction
+        self.memory.db.commit()
+        assert not self.memory.db.in_transaction
+
+    def test_get_db_version(self):
+        self.memory = AgentMemory()
+        joe_memid = PlayerNode.create(self.memory, Player(10, "joe", Pos(1, 0, 1), Look(0, 0)))
+        version = self.memory.get_db_version()
+
+        # reads don't move it
+        self.memory._db_read("SELECT * FROM ReferenceObjects")
+        self.memory._db_read_many(["SELECT * FROM Memories", "SELECT * FROM Triples"])
+        self.memory.get_recent_entities(memtype="Player")
+        assert self.memory.get_db_version() == version
+
+        # writes do
+        self.memory.db_write("UPDATE ReferenceObjects SET x=? WHERE uuid=?", 2, joe_memid)
+        new_version = self.memory.get_db_version()
+        assert new_version != version
+        self.memory.tag(subj_memid=joe_memid, tag_text="plays_football")
+        assert self.memory.get_db_version() != new_version
+
+    def test_compile_search(self):
+        self.memory = AgentMemory()
+        SelfNode.create(
+            self.memory, Player(1, "robot", Pos(0, 0, 0), Look(0, 0)), memid=self.memory.self_memid
+        )
+        joe_memid = PlayerNode.create(self.memory, Player(10, "joe", Pos(1, 0, 1), Look(0, 0)))
+        jane_memid = PlayerNode.create(self.memory, Player(11, "jane", Pos(-1, 0, 1), Look(0, 0)))
+        self.memory.tag(subj_memid=joe_memid, tag_text="plays_football")
+
+        for query in [
+            "SELECT MEMORY FROM ReferenceObject WHERE x<0",
+            "SELECT MEMORY FROM ReferenceObject WHERE (NOT has_tag=plays_football)",
+            "SELECT (x, y) FROM ReferenceObject WHERE has_tag=plays_football",
+        ]:
+            compiled = self.memory.compile_search(query)
+            assert type(compiled) is dict
+            memids, vals = self.memory.basic_search(query)
+            # the compiled query can be reused
+            for _ in range(2):
+                c_memids, c_vals = self.memory.basic_search(compiled)
+                assert c_memids == memids
+                assert [getattr(v, "memid", v) for v in c_vals] == [
+                    getattr(v, "memid", v) for v in vals
+                ]
+        compiled = self.memory.compile_search("SELECT MEMORY FROM ReferenceObject WHERE x<0")
+        memids, _ = self.memory.basic_search(compiled)
+        assert memids == [jane_memid]
+
 
 class PlaceFieldTest(unittest.TestCase):
     def test_place_field(self):
@@ -350,6 +417,37 @@ class PlaceFieldTest(unittest.TestCase):
         assert recovered_pos == (new_jane_x, new_jane_z)
         assert PF.maps[0]["map"].sum() == 6
 
+    def test_place_field_bulk_update(self):
+        memory = AgentMemory()
+        PF = memory.place_field
+        joe_memid = PlayerNode.create(memory, Player(10, "joe", Pos(1, 0, 2), Look(0, 0)))
+        # enough changes to go through update_map_bulk; the last one overwrites the first
+        changes = [{"pos": (1, 0, 2), "memid": joe_memid}]
+        changes.extend({"pos": (-i, 0, 4)} for i in range(10))
+        changes.append({"pos": (1, 0, 2), "is_obstacle": False})
+        PF.update_map(changes)
+        assert PF.maps[0]["map"].sum() == 10
+        assert len(PF.memid2locs["NULL"]) == 11
+        jl = PF.memid2locs[joe_memid]
+        assert len(jl) == 1
+        i, j, h = PF.idx2ijh(list(jl.keys())[0])
+        assert tuple(int(c) for c in PF.map2real(i, j, h)) == (1, 2)
+        assert PF.index2memid[int(PF.maps[h]["memids"][i, j])] == "NULL"
+
+    def test_place_field_grow(self):
+        memory = AgentMemory()
+        PF = memory.place_field
+        joe_memid = PlayerNode.create(memory, Player(10, "joe", Pos(1, 0, 2), Look(0, 0)))
+        PF.update_map([{"pos": (1, 0, 2), "memid": joe_memid}])
+        w = PF.maps[0]["map"].shape[0]
+        # off the edge of the map: the map grows, and joe stays where he was
+        PF.update_map([{"pos": (w, 0, 0)}])
+        assert PF.maps[0]["map"].shape[0] > w
+        assert PF.maps[0]["map"].sum() == 2
+        i, j, h = PF.idx2ijh(list(PF.memid2locs[joe_memid].keys())[0])
+        assert tuple(int(c) for c in PF.map2real(i, j, h)) == (1, 2)
+        assert PF.index2memid[int(PF.maps[h]["memids"][i, j])] == joe_memid
+
 
 if __name__ == "__main__":
     unittest.main()